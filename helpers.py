@@ -78,15 +78,10 @@ def compute_binary_accuracy(eval_preds: EvalPrediction):
             np.float32).mean().item()
     }
 
+# Returns the sorted indices of examples that were forgotten or never answered correctly.
 def return_forgotten():
-    selected_indices = []
-    for i in range(len(forgotten)):
-        if forgotten[i] == True:
-            selected_indices.append(i)
-        elif correctly_answered[i] == False:
-            selected_indices.append(i)
-
-    return selected_indices
+    selected = np.asarray(forgotten, dtype=bool) | ~np.asarray(correctly_answered, dtype=bool)
+    return np.flatnonzero(selected).tolist()
 
 
 
@@ -340,9 +335,11 @@ class QuestionAnsweringTrainer(Trainer):
         if self.compute_metrics is not None:
             # post process the raw predictions to get the final prediction
             # (from start_logits, end_logits to an answer string)
+            # (half-precision evaluation returns fp16 logits, so upcast them to score and rank spans in fp32)
+            predictions = tuple(np.asarray(logits, dtype=np.float32) for logits in output.predictions)
             eval_preds = postprocess_qa_predictions(eval_examples,
                                                     eval_dataset,
-                                                    output.predictions)
+                                                    predictions)
             formatted_predictions = [{"id": k, "prediction_text": v}
                                      for k, v in eval_preds.items()]
             references = [{"id": ex["id"], "answers": ex['answers']}
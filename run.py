@@ -1,14 +1,45 @@
 import datasets
+import numpy as np
+import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, \
     AutoModelForQuestionAnswering, Trainer, TrainerCallback, TrainingArguments, HfArgumentParser
+from transformers.trainer import TRAINING_ARGS_NAME
 from helpers import prepare_dataset_nli, prepare_train_dataset_qa, \
     prepare_validation_dataset_qa, QuestionAnsweringTrainer, compute_accuracy, initialize_forgotten, \
     return_forgotten, change_find_forgettable, compute_binary_accuracy
 import os
 import json
+import hashlib
+import threading
 import copy
+import orjson
 
 NUM_PREPROCESSING_WORKERS = 2
+NLI_PREPROCESSING_BATCH_SIZE = 10000
+FEATURIZED_CACHE_DIR = '.hf_cache'
+JSONL_WRITE_BATCH_SIZE = 8192
+
+# Writes an iterable of dicts to a jsonl file, serializing with orjson and
+# writing lines out in chunks rather than making two writes per row.
+# Note orjson's output differs from json.dumps: compact separators, non-ASCII text as raw UTF-8
+# instead of \u escapes, and NaN/Infinity written as null.
+def dump_jsonl(path, rows):
+    with open(path, mode='wb') as f:
+        lines = []
+        for row in rows:
+            lines.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+            if len(lines) >= JSONL_WRITE_BATCH_SIZE:
+                f.write(b''.join(lines))
+                lines.clear()
+        if lines:
+            f.write(b''.join(lines))
+
+# Iterates over the rows of a Dataset as dicts, converting them from Arrow a batch at a time
+def iterate_rows(dataset, batch_size=JSONL_WRITE_BATCH_SIZE):
+    for start in range(0, len(dataset), batch_size):
+        batch = dataset[start:start + batch_size]
+        for values in zip(*batch.values()):
+            yield dict(zip(batch.keys(), values))
 
 class EvalCallback(TrainerCallback):
     # https://stackoverflow.com/questions/67457480/how-to-get-the-accuracy-per-epoch-or-step-for-the-huggingface-transformers-train
@@ -21,14 +52,47 @@ class EvalCallback(TrainerCallback):
         self.trainer.evaluate()
 
 class SaveCallback(TrainerCallback):
-    def __init__(self, trainer):
+    def __init__(self, trainer, save_every=1.0):
         super().__init__()
         self.trainer = trainer
         self.epoch = 0
+        self.save_every = save_every
+        self.last_saved_epoch = 0
+        self.save_threads = []
         initialize_forgotten(len(trainer.eval_dataset))
 
+    # Mirrors what Trainer.save_model writes for a plain (single-process or DDP) model
+    def save(self, path, state_dict):
+        self.trainer.model.save_pretrained(path, state_dict=state_dict)
+        if self.trainer.tokenizer is not None:
+            self.trainer.tokenizer.save_pretrained(path)
+        torch.save(self.trainer.args, os.path.join(path, TRAINING_ARGS_NAME))
+
     def on_epoch_end(self, args, state, control, **kwargs):
-        self.trainer.save_model(os.path.join(self.trainer.args.output_dir, ('epoch_' + str(state.epoch)[0:4])))
+        # Always save at the end of training, which may stop partway through an epoch
+        # (e.g. a fractional num_train_epochs), so the default of 1.0 saves at every epoch end
+        if state.global_step < state.max_steps and state.epoch - self.last_saved_epoch < self.save_every:
+            return
+        self.last_saved_epoch = state.epoch
+        path = os.path.join(self.trainer.args.output_dir, f'epoch_{state.epoch:.2f}')
+        if args.deepspeed or args.sharded_ddp or args.device.type == 'xla':
+            # DeepSpeed, sharded DDP and TPU checkpoints need Trainer.save_model's own handling
+            self.trainer.save_model(path)
+            return
+        if not self.trainer.is_world_process_zero():
+            return
+        # Copy the weights to the CPU here so the next epoch's updates can't leak into the checkpoint,
+        # then write them out in the background while training continues
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in self.trainer.model.state_dict().items()}
+        thread = threading.Thread(target=self.save, args=(path, state_dict))
+        thread.start()
+        self.save_threads.append(thread)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        # make sure every epoch checkpoint has been written before training returns
+        for thread in self.save_threads:
+            thread.join()
+        self.save_threads.clear()
 
 def main():
     argp = HfArgumentParser(TrainingArguments)
@@ -72,8 +136,28 @@ def main():
                       help='whether or not to train on forgotten examples')
     argp.add_argument('--compute_binary_accuracy', type=str, choices=['True', 'False'], default='False',
                       help='non-entailment samples only counted wrong if classified as entailment')
+    argp.add_argument('--save_every_epochs', type=float, default=1.0,
+                      help='Minimum number of epochs between the per-epoch model checkpoints.')
+    argp.add_argument('--no_mixed_precision', action='store_true',
+                      help='Keep GPU training/evaluation in full fp32 instead of automatically enabling fp16 and TF32.')
+    argp.add_argument('--gradient_checkpointing', action='store_true',
+                      help='Recompute activations during the backward pass to save memory, allowing larger training batch sizes.')
+
+    # Collate batches in background workers by default so batch preparation overlaps with the forward pass
+    # (pass --dataloader_num_workers 0 to collate in the main process instead). Pinned memory for faster
+    # host-to-device copies is already on by default (--no_dataloader_pin_memory turns it off).
+    argp.set_defaults(dataloader_num_workers=min(4, os.cpu_count() or 1))
 
     training_args, args = argp.parse_args_into_dataclasses()
+    # Train with fp16 mixed precision and TF32 matmuls on GPU
+    # (transformers 4.10 has no bf16 support in TrainingArguments, so fp16 is the only half-precision option)
+    if training_args.device.type == 'cuda' and not args.no_mixed_precision:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        training_args.fp16 = True
+        if args.task == 'qa':
+            # QA evaluation runs the model over many long features, so evaluate in half precision too
+            training_args.fp16_full_eval = True
     # uncomment this line when training small datasets on cpu
     # training_args.logging_steps = 9
     
@@ -114,6 +198,15 @@ def main():
     model_class = model_classes[args.task]
     # Initialize the model and tokenizer from the specified pretrained model/checkpoint
     model = model_class.from_pretrained(args.model, **task_kwargs)
+    if training_args.do_train and args.gradient_checkpointing:
+        # transformers 4.10 turns on activation checkpointing through the model config
+        model.config.gradient_checkpointing = True
+        model.config.use_cache = False
+    if training_args.device.type == 'cuda' and torch.cuda.device_count() == 1 and hasattr(torch, 'compile'):
+        # Compile the forward pass into fused kernels. Sequence length is fixed by padding, but batch size (train vs.
+        # eval, partial last batches) still varies, so let Dynamo mark shapes dynamic instead of recompiling per shape.
+        # Only forward is wrapped so the Trainer still sees (and saves) a regular PreTrainedModel.
+        model.forward = torch.compile(model.forward)
     tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
 
     # Select the dataset preprocessing function (these functions are defined in helpers.py)
@@ -127,10 +220,38 @@ def main():
     else:
         raise ValueError('Unrecognized task name: {}'.format(args.task))
 
+    # Featurized splits are cached on disk, keyed by the model, task, sequence length and the raw dataset's
+    # fingerprint, so later runs on the same data memory-map the cached Arrow files instead of re-tokenizing
+    def featurize_dataset(dataset, prepare_dataset, split):
+        cache_key = hashlib.sha1('|'.join(
+            [args.model, args.task, str(args.max_length), dataset._fingerprint]).encode()).hexdigest()[:12]
+        cache_path = os.path.join(FEATURIZED_CACHE_DIR, '{}_{}'.format(cache_key, split))
+        os.makedirs(FEATURIZED_CACHE_DIR, exist_ok=True)
+        if args.task == 'nli':
+            # NLI preprocessing is just a tokenizer call, so run it in this process in large batches
+            # (the fast tokenizer parallelizes each batch itself) rather than forking map workers
+            return dataset.map(
+                prepare_dataset,
+                batched=True,
+                batch_size=NLI_PREPROCESSING_BATCH_SIZE,
+                remove_columns=dataset.column_names,
+                cache_file_name=cache_path + '.arrow'
+            )
+        return dataset.map(
+            prepare_dataset,
+            batched=True,
+            num_proc=NUM_PREPROCESSING_WORKERS,
+            remove_columns=dataset.column_names,
+            cache_file_name=cache_path + '.arrow'
+        )
+
     print("Preprocessing data... (this takes a little bit, should only happen once per dataset)")
     if dataset_id == ('snli',):
         # remove SNLI examples with no label
-        dataset = dataset.filter(lambda ex: ex['label'] != -1)
+        # (mask the label column with numpy instead of calling a Python filter function per example)
+        for split in dataset:
+            labels = np.asarray(dataset[split]['label'])
+            dataset[split] = dataset[split].select(np.flatnonzero(labels != -1).tolist())
     
     train_dataset = None
     eval_dataset = None
@@ -140,26 +261,21 @@ def main():
         train_dataset = eval_dataset = dataset['train']
         if args.max_train_samples:
             train_dataset = train_dataset.select(range(args.max_train_samples))
-        train_dataset_featurized = train_dataset.map(
-            prepare_train_dataset,
-            batched=True,
-            num_proc=NUM_PREPROCESSING_WORKERS,
-            remove_columns=train_dataset.column_names
-        )
+        train_dataset_featurized = featurize_dataset(train_dataset, prepare_train_dataset, 'train')
 
-        # set eval dataset to the same thing as train dataset 
-        eval_dataset_featurized = copy.deepcopy(train_dataset_featurized)
+        # set eval dataset to the same thing as train dataset
+        # (datasets are backed by immutable Arrow tables, so sharing it doesn't need a copy)
+        eval_dataset_featurized = train_dataset_featurized
         
     if training_args.do_eval:
         eval_dataset = dataset[eval_split]
         if args.max_eval_samples:
             eval_dataset = eval_dataset.select(range(args.max_eval_samples))
-        eval_dataset_featurized = eval_dataset.map(
-            prepare_eval_dataset,
-            batched=True,
-            num_proc=NUM_PREPROCESSING_WORKERS,
-            remove_columns=eval_dataset.column_names
-        )
+        eval_dataset_featurized = featurize_dataset(eval_dataset, prepare_eval_dataset, 'eval')
+
+    # Tokenization is done, so turn off tokenizer parallelism before the DataLoader workers fork
+    # (otherwise every forked worker warns that parallelism was already used and disables it itself)
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
 
     # Select the training configuration
     trainer_class = Trainer
@@ -204,14 +320,17 @@ def main():
         eval_callback = EvalCallback(trainer)
         trainer.add_callback(eval_callback)
 
-    save_callback = SaveCallback(trainer)
+    save_callback = SaveCallback(trainer, save_every=args.save_every_epochs)
     trainer.add_callback(save_callback)
     
     # Train and/or evaluate
     if training_args.do_train:
         trainer.train()
         trainer.save_model()
-        trainer.evaluate()
+        # The do_eval block below evaluates again anyway, unless this evaluation is needed
+        # to record which examples were forgotten in the last epoch
+        if not training_args.do_eval or args.num_forgotten_epochs != 0:
+            trainer.evaluate()
 
         # If you want to customize the way the loss is computed, you should subclass Trainer and override the "compute_loss"
         # method (see https://huggingface.co/transformers/_modules/transformers/trainer.html#Trainer.compute_loss).
@@ -223,42 +342,41 @@ def main():
     if args.num_forgotten_epochs != 0:
         # obtain indices of forgotten examples
         change_find_forgettable(False)
+        # (already sorted and unique, since return_forgotten builds them from a boolean mask)
         forgotten_indices = return_forgotten()
 
         # write forgotten examples to json file
-        with open(os.path.join(training_args.output_dir, 'forgotten_examples.jsonl'), encoding='utf-8', mode='w') as f:
-            for i, example in enumerate(eval_dataset):
-                if(i in forgotten_indices):
-                    example_with_prediction = dict(example)
-                    f.write(json.dumps(example_with_prediction))
-                    f.write('\n')
+        # (gather just the forgotten rows instead of scanning the whole eval set)
+        forgotten_examples = eval_dataset.select(forgotten_indices)
+        dump_jsonl(os.path.join(training_args.output_dir, 'forgotten_examples.jsonl'), iterate_rows(forgotten_examples))
 
         # create new dataset consisting only of forgotten examples
         forgotten_dataset = trainer.eval_dataset.select(forgotten_indices)
-        forget_args = copy.deepcopy(training_args)
-
-        # Uncomment if training with small dataset on cpu
-        # forget_args.logging_steps = 3
 
         # Save output of args to subfolder
+        # (a shallow copy keeps the already set-up devices; dataclasses.replace would rerun __post_init__ and
+        # device setup, which calls torch.distributed.init_process_group a second time in distributed runs)
+        forget_args = copy.copy(training_args)
         forget_args.output_dir = os.path.join(training_args.output_dir, 'forgotten')
         forget_args.num_train_epochs = args.num_forgotten_epochs
 
+        # Uncomment if training with small dataset on cpu
+        # forget_args.logging_steps = 3
+
         # create new forget trainer that picks up where original trainer left off and trains
         # only on forgotten examples
         forget_model = model_class.from_pretrained(training_args.output_dir, **task_kwargs)
-        forget_tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
         forget_trainer = trainer_class(
             model=forget_model,
             args=forget_args,
             train_dataset=forgotten_dataset,
             eval_dataset=forgotten_dataset,
-            tokenizer=forget_tokenizer,
+            tokenizer=tokenizer,
             compute_metrics=compute_metrics_and_store_predictions
         )
         forget_eval_callback = EvalCallback(forget_trainer)
         forget_trainer.add_callback(forget_eval_callback)
-        forget_save_callback = SaveCallback(forget_trainer)
+        forget_save_callback = SaveCallback(forget_trainer, save_every=args.save_every_epochs)
         forget_trainer.add_callback(forget_save_callback)
         
         forget_trainer.train()
@@ -282,21 +400,21 @@ def main():
         with open(os.path.join(training_args.output_dir, 'eval_metrics.json'), encoding='utf-8', mode='w') as f:
             json.dump(results, f)
 
-        with open(os.path.join(training_args.output_dir, 'eval_predictions.jsonl'), encoding='utf-8', mode='w') as f:
-            if args.task == 'qa':
-                predictions_by_id = {pred['id']: pred['prediction_text'] for pred in eval_predictions.predictions}
-                for example in eval_dataset:
-                    example_with_prediction = dict(example)
-                    example_with_prediction['predicted_answer'] = predictions_by_id[example['id']]
-                    f.write(json.dumps(example_with_prediction))
-                    f.write('\n')
-            else:
-                for i, example in enumerate(eval_dataset):
-                    example_with_prediction = dict(example)
-                    example_with_prediction['predicted_scores'] = eval_predictions.predictions[i].tolist()
-                    example_with_prediction['predicted_label'] = int(eval_predictions.predictions[i].argmax())
-                    f.write(json.dumps(example_with_prediction))
-                    f.write('\n')
+        if args.task == 'qa':
+            # line the predictions up with the id column, then attach them as a new column
+            # so rows are read out of Arrow in batches instead of one example at a time
+            predictions_by_id = {pred['id']: pred['prediction_text'] for pred in eval_predictions.predictions}
+            predicted_answers = [predictions_by_id[example_id] for example_id in eval_dataset['id']]
+            examples_with_predictions = iterate_rows(eval_dataset.add_column('predicted_answer', predicted_answers))
+        else:
+            # convert the whole prediction array at once rather than row by row
+            predicted_scores = eval_predictions.predictions.tolist()
+            predicted_labels = eval_predictions.predictions.argmax(axis=1).tolist()
+            examples_with_predictions = (
+                {**example, 'predicted_scores': scores, 'predicted_label': label}
+                for example, scores, label in zip(iterate_rows(eval_dataset), predicted_scores, predicted_labels)
+            )
+        dump_jsonl(os.path.join(training_args.output_dir, 'eval_predictions.jsonl'), examples_with_predictions)
 
 
 if __name__ == "__main__":